@@ -0,0 +1,58 @@
+import threading
+from datetime import datetime
+
+
+# Keeps running plant totals of the given fields across all member devices.
+# Each update only swaps the member's previous contribution for its new one,
+# so the cost does not depend on the number of devices on the plant.
+class PlantAggregator:
+    def __init__(self, fields, daily_fields, stale_after_in_seconds):
+        self.fields = tuple(fields) + tuple(daily_fields)
+        # Daily totals such as today's generation only ever grow during the day, so a stale member
+        # keeps its share of them until the day rolls over
+        self.daily_fields = tuple(daily_fields)
+        self.instant_fields = tuple(fields)
+        self.stale_after_in_seconds = stale_after_in_seconds
+        self.totals = dict.fromkeys(self.fields, 0)
+        self.members = dict()  # member -> (updated_at, contribution)
+        self.stale = set()
+        self.lock = threading.Lock()
+
+    def update(self, member, values, updated_at):
+        contribution = {field: values[field] for field in self.fields}
+        with self.lock:
+            previous = self.members.get(member)
+            for field in self.fields:
+                self.totals[field] += contribution[field] - (previous[1][field] if previous else 0)
+            self.members[member] = (updated_at, contribution)
+            self.stale.discard(member)
+
+    def _drop(self, member, fields):
+        contribution = self.members[member][1]
+        for field in fields:
+            self.totals[field] -= contribution[field]
+            contribution[field] = 0
+
+    def expire(self, now):
+        # Leave members whose latest data is too old out of the instantaneous totals, e.g. an inverter
+        # that went offline, and forget them entirely once their data is from an earlier day
+        today = datetime.fromtimestamp(now).date()
+        newly_stale = []
+        with self.lock:
+            for (member, (updated_at, _)) in list(self.members.items()):
+                if datetime.fromtimestamp(updated_at).date() != today:
+                    self._drop(member, self.fields)
+                    del self.members[member]
+                    self.stale.discard(member)
+                elif member not in self.stale and now - updated_at > self.stale_after_in_seconds:
+                    self._drop(member, self.instant_fields)
+                    self.stale.add(member)
+                    newly_stale.append(member)
+        return newly_stale
+
+    def snapshot(self):
+        with self.lock:
+            totals = {field: round(value, 3) for (field, value) in self.totals.items()}
+            totals['members'] = sorted(set(self.members) - self.stale)
+            totals['stale_members'] = sorted(self.stale)
+        return totals
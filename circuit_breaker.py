@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+
+import config
+from utils import log
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_in):
+        super().__init__(f'Circuit "{name}" is open, retrying in {retry_in:.0f} seconds')
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, name,
+                 failure_threshold=config.breaker_failure_threshold,
+                 base_delay=config.backoff_base_in_seconds,
+                 max_delay=config.backoff_max_in_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = CLOSED
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.lock = threading.Lock()
+
+    def backoff(self):
+        # Exponential backoff with "equal jitter" so a fleet of daemons does not retry in lockstep
+        exponent = max(0, self.failures - 1)
+        delay = min(self.max_delay, self.base_delay * (2 ** exponent))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def retry_in(self):
+        return max(0.0, self.next_attempt - time.time())
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                # Failures below the threshold still wait out their backoff before the next attempt
+                return time.time() >= self.next_attempt
+            if self.state == OPEN and time.time() >= self.next_attempt:
+                # Let a single probe through, everyone else waits for its result
+                self.state = HALF_OPEN
+                log('Circuit "{}" half-open, probing', self.name)
+                return True
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_in())
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                log('Circuit "{}" closed', self.name)
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.next_attempt = time.time() + self.backoff()
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                log('Circuit "{}" open after {} failures, retrying in {:.0f} seconds',
+                    self.name, self.failures, self.retry_in())
+
+    def release_probe(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def call(self, function, *args, **kwargs):
+        self.check()
+        try:
+            result = function(*args, **kwargs)
+        except CircuitOpenError:
+            # A nested circuit rejected the call, which says nothing about this one
+            self.release_probe()
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    with _breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name)
+        return breakers[name]
@@ -1,5 +1,11 @@
 debug = False  # True to enable, False to disable
 
+# Tracing settings
+trace = False  # True to record timing spans for every polling cycle
+trace_buffer_size = 200  # Number of recent spans kept in memory and dumped to error_log.txt on errors
+trace_file = None  # Optional JSONL file to append spans to, e.g. 'trace.jsonl'
+trace_file_max_bytes = 1024 * 1024  # Trace file is rotated to '<trace_file>.1' once it grows past this size
+
 # Shinemonitor settings
 base_url = 'http://android.shinemonitor.com/public/'
 usr = ''  # Username
@@ -9,9 +15,22 @@ plant_id = ''  # Plant id (Power station ID). Obtained from portal.
 pn = ''  # Datalogger PN number. Obtained from portal
 sn = ''  # Device serial number. Obtained from portal
 devcode = ''  # Device coding. Obtained from portal
+# Additional devices on the same plant, each with its own MQTT sensor name, e.g.
+# devices = [dict(pn='', sn='', devcode='', sensor_name='shinemonitor-reporter-2')]
+devices = []
+# Publish a virtual plant device with the summed power, battery flow and generation of all devices
+plant_aggregate = False
+plant_sensor_name = 'shinemonitor-plant'
+plant_stale_after_in_minutes = 15  # Devices without newer data than this are left out of the plant totals
+
+# Retry settings, applied per API endpoint and per MQTT broker
+breaker_failure_threshold = 3  # Consecutive failures before the circuit opens and calls are skipped
+backoff_base_in_seconds = 30  # Delay after the first failure, doubled for every further failure
+backoff_max_in_seconds = 30 * 60  # Upper bound for the backoff delay
 
 # MQTT settings
 interval_in_minutes = 5
+refresh_min_interval_in_seconds = 60  # Minimum spacing between refreshes requested over MQTT per device
 hostname = 'localhost'
 port = 1883
 discovery_prefix = 'homeassistant'
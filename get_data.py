@@ -1,13 +1,17 @@
 #!/usr/bin/python3
 import hashlib
+import json
 import sys
+import threading
 import time as time_  # make sure we don't override time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import requests
 
 import config
-from utils import log
+from circuit_breaker import get_breaker
+from utils import log, span
 
 # API Reference: http://android.shinemonitor.com/
 
@@ -17,6 +21,13 @@ default_params = ('&i18n=en_US'
                   '&_app_client_=android'
                   '&_app_id_=wifiapp.volfw.solarpower'
                   '&_app_version_=1.1.0.1')
+token_lock = threading.Lock()
+
+
+def configured_devices():
+    # The device set up in config.py comes first, followed by any additional devices on the same plant
+    primary = dict(pn=config.pn, sn=config.sn, devcode=config.devcode, sensor_name=config.sensor_name)
+    return [primary] + list(config.devices)
 
 
 def get_salt():
@@ -24,38 +35,40 @@ def get_salt():
 
 
 def get_token():
-    try:
-        with open('token', 'r') as file:
-            log("Using tokenfile credentials")
+    # Polls of several devices can run at once, only one of them may read or renew the token file
+    with token_lock:
+        try:
+            with open('token', 'r') as file:
+                log("Using tokenfile credentials")
 
-            token = file.readline().strip()
-            secret = file.readline().strip()
-            expiry = file.readline().strip()
+                token = file.readline().strip()
+                secret = file.readline().strip()
+                expiry = file.readline().strip()
 
-            # Check if token expired
-            d = datetime.now().today()
-            e = datetime.strptime(expiry, '%Y-%m-%d %H:%M:%S.%f')
+                # Check if token expired
+                d = datetime.now().today()
+                e = datetime.strptime(expiry, '%Y-%m-%d %H:%M:%S.%f')
 
-            log("Datetime now:  " + str(d))
-            log("Expires:       " + str(e))
+                log("Datetime now:  " + str(d))
+                log("Expires:       " + str(e))
 
-            if d > e:
-                log("Expired")
-                raise FileNotFoundError
-            else:
-                log("Not expired")
+                if d > e:
+                    log("Expired")
+                    raise FileNotFoundError
+                else:
+                    log("Not expired")
 
-    except FileNotFoundError:
-        log("Logging in using credentials")
+        except FileNotFoundError:
+            log("Logging in using credentials")
 
-        token, secret, expiry = generate_token(get_salt())
+            token, secret, expiry = get_breaker('api:authSource').call(generate_token, get_salt())
 
-        with open('token', 'w') as file:
-            file.write(token + '\n')
-            file.write(secret + '\n')
-            file.write(str(expiry))
+            with open('token', 'w') as file:
+                file.write(token + '\n')
+                file.write(secret + '\n')
+                file.write(str(expiry))
 
-    return token, secret
+        return token, secret
 
 
 def generate_token(salt):
@@ -66,17 +79,21 @@ def generate_token(salt):
     action = '&action=authSource&usr=' + str(config.usr) + '&company-key=' + str(config.company_key) + default_params;
     pwd_action = str(salt) + str(pwd_sha1.hexdigest()) + action  # This complete string needs SHA1
 
-    sign_sha1 = hashlib.sha1()
-    sign_sha1.update(pwd_action.encode('utf-8'))
-    sign = str(sign_sha1.hexdigest())
+    with span('sign_url', action='authSource'):
+        sign_sha1 = hashlib.sha1()
+        sign_sha1.update(pwd_action.encode('utf-8'))
+        sign = str(sign_sha1.hexdigest())
 
-    solar_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + action
+        solar_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + action
     log(solar_url)
-    r = requests.get(solar_url)
+    with span('http_fetch', action='authSource'):
+        r = requests.get(solar_url)
+    with span('json_decode', action='authSource'):
+        dat = r.json()['dat']
 
-    token = r.json()['dat']['token']
-    secret = r.json()['dat']['secret']
-    expiry = r.json()['dat']['expire']
+    token = dat['token']
+    secret = dat['secret']
+    expiry = dat['expire']
 
     # Convert expiry to datetime when expiring
     today = datetime.now().today()
@@ -95,66 +112,66 @@ def build_request_url(action, salt, secret, token, devcode, pn, sn, plant_id=Non
         action += '&date=' + date
     action += default_params
 
-    # need to sign entire request url with params
-    secret_action = str(salt) + secret + token + action
-    sign_sha1 = hashlib.sha1()
-    sign_sha1.update(secret_action.encode('utf-8'))
-    sign = str(sign_sha1.hexdigest())
+    return sign_request_url(action, salt, secret, token)
 
-    request_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + '&token=' + token + action
-    return request_url
 
+def sign_request_url(action, salt, secret, token):
+    with span('sign_url'):
+        # need to sign entire request url with params
+        secret_action = str(salt) + secret + token + action
+        sign_sha1 = hashlib.sha1()
+        sign_sha1.update(secret_action.encode('utf-8'))
+        sign = str(sign_sha1.hexdigest())
 
-def get_device_info(token, secret):
-    action = 'queryDeviceInfo'
-    action = '&action=' + action
-    action += '&device=' + ','.join([config.pn, config.devcode, '1', config.sn])
-    action += default_params
+        request_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + '&token=' + token + action
+    return request_url
 
-    salt = get_salt()
-    # need to sign entire request url with params
-    secret_action = str(salt) + secret + token + action
-    sign_sha1 = hashlib.sha1()
-    sign_sha1.update(secret_action.encode('utf-8'))
-    sign = str(sign_sha1.hexdigest())
 
-    request_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + '&token=' + token + action
+def request_data(request_url, action, device=None):
+    # Device endpoints get a breaker per device so one faulty inverter does not block the others
+    breaker = get_breaker('api:' + action + (':' + device['sn'] if device else ''))
+    breaker.check()
 
     log(request_url)
-    response = requests.get(request_url)
-    errcode = response.json()['err']
+    try:
+        with span('http_fetch', action=action):
+            response = requests.get(request_url)
+        with span('json_decode', action=action):
+            response_json = response.json()
+        errcode = response_json['err']
+    except Exception:
+        breaker.record_failure()
+        raise
 
     if errcode == 0:
-        data = response.json()['dat']
+        breaker.record_success()
+        data = response_json['dat']
         return data
     else:
+        breaker.record_failure()
         return '{ErrorCode: ' + str(errcode) + '}'
 
 
-def get_device_status(token, secret):
-    action = 'queryDeviceStatus'
+def get_device_info(token, secret, device=None):
+    device = device or configured_devices()[0]
+    action = 'queryDeviceInfo'
     action = '&action=' + action
-    action += '&device=' + ','.join([config.pn, config.devcode, '1', config.sn])
+    action += '&device=' + ','.join([device['pn'], device['devcode'], '1', device['sn']])
     action += default_params
 
-    salt = get_salt()
-    # need to sign entire request url with params
-    secret_action = str(salt) + secret + token + action
-    sign_sha1 = hashlib.sha1()
-    sign_sha1.update(secret_action.encode('utf-8'))
-    sign = str(sign_sha1.hexdigest())
+    request_url = sign_request_url(action, get_salt(), secret, token)
+    return request_data(request_url, 'queryDeviceInfo', device)
 
-    request_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + '&token=' + token + action
 
-    log(request_url)
-    response = requests.get(request_url)
-    errcode = response.json()['err']
+def get_device_status(token, secret, device=None):
+    device = device or configured_devices()[0]
+    action = 'queryDeviceStatus'
+    action = '&action=' + action
+    action += '&device=' + ','.join([device['pn'], device['devcode'], '1', device['sn']])
+    action += default_params
 
-    if errcode == 0:
-        data = response.json()['dat']
-        return data
-    else:
-        return '{ErrorCode: ' + str(errcode) + '}'
+    request_url = sign_request_url(action, get_salt(), secret, token)
+    return request_data(request_url, 'queryDeviceStatus', device)
 
 
 def update_plant_info(token, secret, parameter, value):
@@ -164,18 +181,13 @@ def update_plant_info(token, secret, parameter, value):
     action += '&' + parameter + '=' + value
     action += default_params
 
-    salt = get_salt()
-    # need to sign entire request url with params
-    secret_action = str(salt) + secret + token + action
-    sign_sha1 = hashlib.sha1()
-    sign_sha1.update(secret_action.encode('utf-8'))
-    sign = str(sign_sha1.hexdigest())
-
-    request_url = config.base_url + '?sign=' + sign + '&salt=' + str(salt) + '&token=' + token + action
+    request_url = sign_request_url(action, get_salt(), secret, token)
 
     log(request_url)
-    response = requests.post(request_url)
-    errcode = response.json()['err']
+    with span('http_fetch', action='editPlant'):
+        response = requests.post(request_url)
+    with span('json_decode', action='editPlant'):
+        errcode = response.json()['err']
 
     if errcode == 0:
         return response
@@ -189,33 +201,52 @@ def get_plant_info(token, secret):
                                     config.devcode, config.pn, config.sn,
                                     plant_id=config.plant_id,
                                     date=datetime.today().strftime('%Y-%m-%d'))
+    return request_data(request_url, 'queryPlantInfo')
 
-    log(request_url)
-    response = requests.get(request_url)
-    errcode = response.json()['err']
-
-    if errcode == 0:
-        data = response.json()['dat']
-        return data
-    else:
-        return '{ErrorCode: ' + str(errcode) + '}'
 
-
-def get_generation_latest(token, secret):
+def get_generation_latest(token, secret, device=None):
+    device = device or configured_devices()[0]
     request_url = build_request_url('queryDeviceLastData',
                                     (get_salt()), secret, token,
-                                    config.devcode, config.pn, config.sn,
+                                    device['devcode'], device['pn'], device['sn'],
                                     date=datetime.today().strftime('%Y-%m-%d'))
+    return request_data(request_url, 'queryDeviceLastData', device)
 
-    log(request_url)
-    response = requests.get(request_url)
-    errcode = response.json()['err']
 
-    if errcode == 0:
-        data = response.json()['dat']
-        return data
-    else:
-        return '{ErrorCode: ' + str(errcode) + '}'
+def timed_call(function, *args):
+    start = time_.perf_counter()
+    try:
+        data = function(*args)
+        # API errors come back from request_data() as an '{ErrorCode: N}' string rather than an exception
+        if isinstance(data, str) and data.startswith('{ErrorCode'):
+            result = dict(error=data)
+        else:
+            result = dict(data=data)
+    except Exception as e:
+        result = dict(error=repr(e))
+    result['duration_ms'] = round((time_.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def get_snapshot(token, secret, devices):
+    # Query every endpoint at once so the whole snapshot takes roughly one request latency
+    calls = [('plant', None, 'plantInfo', get_plant_info, ())]
+    for device in devices:
+        calls += [('devices', device['sn'], 'latest', get_generation_latest, (device,)),
+                  ('devices', device['sn'], 'deviceInfo', get_device_info, (device,)),
+                  ('devices', device['sn'], 'deviceStatus', get_device_status, (device,))]
+
+    start = time_.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [(group, sn, name, executor.submit(timed_call, function, token, secret, *args))
+                   for (group, sn, name, function, args) in calls]
+
+    snapshot = dict(plant=dict(), devices=dict())
+    for (group, sn, name, future) in futures:
+        target = snapshot[group] if sn is None else snapshot[group].setdefault(sn, dict())
+        target[name] = future.result()
+    snapshot['duration_ms'] = round((time_.perf_counter() - start) * 1000, 1)
+    return snapshot
 
 
 if __name__ == '__main__':
@@ -233,3 +264,6 @@ if __name__ == '__main__':
             print(get_device_info(token, secret))
         if endpoint == '--deviceStatus':
             print(get_device_status(token, secret))
+        if endpoint == '--snapshot':
+            devices = configured_devices() if '--all' in sys.argv[2:] else configured_devices()[:1]
+            print(json.dumps(get_snapshot(token, secret, devices), indent=2, default=str))
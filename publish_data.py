@@ -5,6 +5,7 @@ import time
 import traceback
 from requests.exceptions import ConnectionError
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from time import sleep
 
@@ -12,8 +13,10 @@ from paho.mqtt import client as mqtt
 from tzlocal import get_localzone
 
 import config
-from get_data import get_token, get_generation_latest
-from utils import log
+from aggregator import PlantAggregator
+from circuit_breaker import CircuitOpenError, get_breaker
+from get_data import configured_devices, get_token, get_generation_latest
+from utils import log, span, open_span, start_cycle, dump_trace, get_trace_context, set_trace_context
 
 # -----------------------------------------------------------------------------
 #  Sensor Definitions
@@ -35,13 +38,16 @@ TODAY_GENERATION = 'today_generation'
 MONTH_GENERATION = 'month_generation'
 YEAR_GENERATION = 'year_generation'
 TOTAL_GENERATION = 'total_generation'
+PLANT = 'plant'
+BATTERY_POWER = 'battery_power'
+MEMBERS_ONLINE = 'members_online'
 
 detectors = OrderedDict([
     (SHINE_MONITOR, dict(
         title='Shine Monitor',
         topic_category='sensor',
         device_class='timestamp',
-        device_ident="ShineMonitor-{}".format(config.sensor_name),
+        device_ident="ShineMonitor-{}",
         icon='mdi:meter-electric-outline',
         json_attr='yes',
         json_value='timestamp',
@@ -174,6 +180,57 @@ detectors = OrderedDict([
 
 ])
 
+# Virtual device with the totals of every device on the plant
+plant_detectors = OrderedDict([
+    (PLANT, dict(
+        title='Plant Devices Online',
+        topic_category='sensor',
+        state_class='measurement',
+        device_ident="ShineMonitor-{}",
+        icon='mdi:solar-power-variant-outline',
+        json_attr='yes',
+        json_value=MEMBERS_ONLINE,
+    )),
+    (PV_INPUT_POWER, dict(
+        title='Plant PV Input Power',
+        topic_category='sensor',
+        device_class='power',
+        state_class='measurement',
+        unit='W',
+        icon='mdi:solar-power',
+        json_value=PV_INPUT_POWER,
+    )),
+    (AC_OUTPUT_ACTIVE_POWER, dict(
+        title='Plant AC output active power',
+        topic_category='sensor',
+        device_class='power',
+        state_class='measurement',
+        unit='W',
+        icon='mdi:home-lightning-bolt',
+        json_value=AC_OUTPUT_ACTIVE_POWER,
+    )),
+    (BATTERY_POWER, dict(
+        title='Plant Battery Power',
+        topic_category='sensor',
+        device_class='power',
+        state_class='measurement',
+        unit='W',
+        icon='mdi:home-battery',
+        json_value=BATTERY_POWER,
+    )),
+    (TODAY_GENERATION, dict(
+        title='Plant Today generation',
+        topic_category='sensor',
+        device_class='energy',
+        state_class='total_increasing',
+        unit='Wh',
+        icon='mdi:solar-power-variant',
+        json_value=TODAY_GENERATION,
+    )),
+])
+PLANT_FIELDS = (PV_INPUT_POWER, AC_OUTPUT_ACTIVE_POWER, BATTERY_POWER)
+PLANT_DAILY_FIELDS = (TODAY_GENERATION,)
+
 # -----------------------------------------------------------------------------
 #  Timer for MQTT Alive Status Functions
 # -----------------------------------------------------------------------------
@@ -193,28 +250,53 @@ def publish_shutdown_status():
 
 def alive_timeout_handler():
     log('-- MQTT KeepAlive Timeout --')
-    _thread.start_new_thread(publish_alive_status, ())
-    start_alive_timer()
+    with alive_timer_lock:
+        # The timer may have been stopped by another thread while this one was firing
+        if not is_alive_timer_running():
+            return
+        _thread.start_new_thread(publish_alive_status, ())
+        start_alive_timer()
 
 
 def start_alive_timer():
     global alive_timer
     global alive_timer_running_status
-    stop_alive_timer()
-    alive_timer = threading.Timer(ALIVE_TIMEOUT_IN_SECONDS, alive_timeout_handler)
-    alive_timer.start()
-    alive_timer_running_status = True
+    with alive_timer_lock:
+        stop_alive_timer()
+        alive_timer = threading.Timer(ALIVE_TIMEOUT_IN_SECONDS, alive_timeout_handler)
+        alive_timer.start()
+        alive_timer_running_status = True
     log('Started MQTT timer - every {} seconds'.format(ALIVE_TIMEOUT_IN_SECONDS))
 
 
 def stop_alive_timer():
     global alive_timer
     global alive_timer_running_status
-    alive_timer.cancel()
-    alive_timer_running_status = False
+    with alive_timer_lock:
+        alive_timer.cancel()
+        alive_timer_running_status = False
     log('Stopped MQTT timer')
 
 
+def mark_online():
+    # Polls run concurrently, so checking and starting the timer must happen under one lock
+    with alive_timer_lock:
+        if is_alive_timer_running():
+            return
+        publish_alive_status()
+        start_alive_timer()
+
+
+def mark_offline():
+    # Returns whether the reporter was online, so the caller only logs the outage once
+    with alive_timer_lock:
+        if not is_alive_timer_running():
+            return False
+        mqtt_client.publish(lwt_sensor_topic, payload=lwt_offline_val, retain=False)
+        stop_alive_timer()
+        return True
+
+
 def is_alive_timer_running():
     global alive_timer_running_status
     return alive_timer_running_status
@@ -222,6 +304,7 @@ def is_alive_timer_running():
 
 alive_timer = threading.Timer(ALIVE_TIMEOUT_IN_SECONDS, alive_timeout_handler)
 alive_timer_running_status = False
+alive_timer_lock = threading.RLock()
 
 
 # -----------------------------------------------------------------------------
@@ -231,25 +314,61 @@ alive_timer_running_status = False
 
 def on_connect(client, userdata, flags, rc):
     global mqtt_client_connected
+    global mqtt_client_announced
     if rc == 0:
         print("Connected to MQTT Broker!")
         mqtt_client_connected = True
+        broker_breaker.record_success()
+        # Subscribing here means the subscription is restored on every reconnect
+        client.subscribe(refresh_topic, qos=1)
+        # After a reconnect the broker only holds our offline will, so announce ourselves again
+        if mqtt_client_announced:
+            _thread.start_new_thread(announce_online, ())
+        mqtt_client_announced = True
     else:
         print("Failed to connect, return code %d\n", rc)
-        exit(1)
+        broker_breaker.record_failure()
 
 
-def on_disconnect(client, userdata, mid):
+def on_disconnect(client, userdata, rc):
     global mqtt_client_connected
     mqtt_client_connected = False
     log("MQTT connection lost - disconnected.")
-    pass
+    if rc != 0:
+        # Unexpected disconnect, paho reconnects on its own starting from a jittered delay
+        broker_breaker.record_failure()
+        client.reconnect_delay_set(min_delay=max(1, int(broker_breaker.backoff())),
+                                   max_delay=config.backoff_max_in_seconds)
+
+
+def on_message(client, userdata, message):
+    # This runs on the network thread, so a bad message must never raise out of here
+    try:
+        # An empty payload or 'all' refreshes every device, otherwise the payload names a device by sn or sensor name
+        target = message.payload.decode('utf-8', errors='replace').strip()
+        selected = [device for device in devices if target in ('', 'all', device['sn'], device['sensor_name'])]
+        if not selected:
+            log("Ignoring refresh request for unknown device '{}'", target)
+            return
+        # Never block the network loop
+        _thread.start_new_thread(refresh_devices, (selected,))
+    except Exception:
+        log("Exception Found: " + traceback.format_exc())
+
+
+def announce_online():
+    publish_discovery_topic()
+    # Only report online if the API side is healthy, otherwise the next successful poll does it
+    if is_alive_timer_running():
+        publish_alive_status()
 
 
 def connect_mqtt():
     print("Connecting to MQTT broker ...")
 
     client = mqtt.Client()
+    # Keep the network loop running if one of our callbacks fails
+    client.suppress_exceptions = True
 
     # Setup username and password if available
     if config.username and config.password:
@@ -258,41 +377,105 @@ def connect_mqtt():
     # hook up MQTT callbacks
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.on_publish = on_publish
 
     client.will_set(lwt_sensor_topic, payload=lwt_offline_val, retain=True)
 
-    try:
-        client.connect(config.hostname, port=config.port, keepalive=60)
-    except:
-        print('MQTT connection error. Please check your settings in the configuration file "config.py"')
-        exit(1)
-    else:
-        client.publish(lwt_sensor_topic, payload=lwt_online_val, retain=False)
-        client.loop_start()
-
-        while not mqtt_client_connected:  # wait in loop
-            sleep(1.0)  # some slack to establish the connection
-
-        # Publish alive status again (in case above one published before connect)
-        client.publish(lwt_sensor_topic, payload=lwt_online_val, retain=False)
-        start_alive_timer()
+    # Keep retrying with backoff instead of exiting, the broker may still be starting up
+    while True:
+        try:
+            broker_breaker.call(client.connect, config.hostname, port=config.port, keepalive=60)
+        except CircuitOpenError as e:
+            log(str(e))
+            sleep(max(1.0, e.retry_in))
+        except Exception:
+            print('MQTT connection error. Please check your settings in the configuration file "config.py"')
+            sleep(max(1.0, broker_breaker.retry_in()))
+        else:
+            break
+
+    client.publish(lwt_sensor_topic, payload=lwt_online_val, retain=False)
+    client.loop_start()
+
+    while not mqtt_client_connected:  # wait in loop
+        sleep(1.0)  # some slack to establish the connection
+
+    # Publish alive status again (in case above one published before connect)
+    client.publish(lwt_sensor_topic, payload=lwt_online_val, retain=False)
+    start_alive_timer()
 
     return client
 
 
-def publish(topic, message, retain=False):
-    log('Publishing to MQTT topic "{}, Data:{}"'.format(topic, message))
+def publish(topic, message, retain=False, trace_context=None):
+    if trace_context is not None:
+        set_trace_context(trace_context)
+    log('Publishing to MQTT topic "{}, Data:{}"', topic, message)
+    trace = open_span('mqtt_ack', topic=topic)
     result = mqtt_client.publish(topic, message, 1, retain=retain)
+    if trace is not None:
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            track_ack(result.mid, trace)
+        else:
+            trace.close(error=mqtt.error_string(result.rc))
     # result: [0, 1]
     status = result[0]
     if status == 0:
-        log(f"Sent `{message}` to topic `{topic}`")
+        log("Sent `{}` to topic `{}`", message, topic)
     else:
-        log(f"Failed to send message to topic {topic}")
+        log("Failed to send message to topic {}", topic)
     sleep(0.5)
 
 
+def expire_acks(now):
+    # Called with ack_lock held. Drops acks nobody traced (e.g. QoS 0 heartbeats) and returns
+    # the traced messages whose ack never arrived, so their spans can be closed as failed.
+    for (mid, acked_at) in list(early_acks.items()):
+        if now - acked_at > MQTT_ACK_TIMEOUT_IN_SECONDS:
+            del early_acks[mid]
+    timed_out = [mid for (mid, trace) in pending_acks.items() if now - trace.perf_start > MQTT_ACK_TIMEOUT_IN_SECONDS]
+    return [pending_acks.pop(mid) for mid in timed_out]
+
+
+def track_ack(mid, trace):
+    # The ack can arrive before publish() returns the mid, in which case on_publish already noted its time
+    now = time.perf_counter()
+    with ack_lock:
+        timed_out = expire_acks(now)
+        acked_at = early_acks.pop(mid, None)
+        if acked_at is None:
+            pending_acks[mid] = trace
+    for expired in timed_out:
+        expired.close(error='no ack')
+    if acked_at is not None:
+        trace.close(perf_end=acked_at)
+
+
+def on_publish(client, userdata, mid):
+    if not config.trace:
+        return
+    acked_at = time.perf_counter()
+    with ack_lock:
+        timed_out = expire_acks(acked_at)
+        trace = pending_acks.pop(mid, None)
+        if trace is None:
+            early_acks[mid] = acked_at
+    for expired in timed_out:
+        expired.close(error='no ack')
+    if trace is not None:
+        trace.close(perf_end=acked_at)
+
+
 mqtt_client_connected = False
+mqtt_client_announced = False
+broker_breaker = get_breaker('mqtt:{}:{}'.format(config.hostname, config.port))
+# Traced messages waiting for their PUBACK, and acks that arrived before publish() returned, keyed by
+# message id. Both are expired after the timeout so untraced and never acknowledged messages do not pile up.
+MQTT_ACK_TIMEOUT_IN_SECONDS = 10
+ack_lock = threading.Lock()
+pending_acks = dict()
+early_acks = dict()
 
 
 # -----------------------------------------------------------------------------
@@ -300,8 +483,7 @@ mqtt_client_connected = False
 # -----------------------------------------------------------------------------
 
 
-def prepare_payload(data):
-    global prev_total_generation
+def prepare_payload(data, device):
     payload = OrderedDict()
     payload['id'] = data['id']['val']
     payload['timestamp'] = (datetime.strptime(data['Timestamp']['val'], '%Y-%m-%d %H:%M:%S')
@@ -331,9 +513,9 @@ def prepare_payload(data):
     # Weird error with '-' coming in for some reason in Total generation response
     try:
         payload[TOTAL_GENERATION] = float(data['Total generation']['val'])
-        prev_total_generation = payload[TOTAL_GENERATION]
+        prev_total_generation[device['sn']] = payload[TOTAL_GENERATION]
     except ValueError:
-        payload[TOTAL_GENERATION] = prev_total_generation
+        payload[TOTAL_GENERATION] = prev_total_generation.get(device['sn'], 0.0)
 
     payload['last_updated'] = datetime.now(local_tz).astimezone().replace(microsecond=0).isoformat()
 
@@ -342,7 +524,29 @@ def prepare_payload(data):
     return payload_info
 
 
-def prepare_discovery_payload(sensor, params):
+def prepare_plant_contribution(payload):
+    contribution = dict()
+    contribution[PV_INPUT_POWER] = payload[PV_INPUT_POWER]
+    contribution[AC_OUTPUT_ACTIVE_POWER] = payload[AC_OUTPUT_ACTIVE_POWER]
+    # Positive while charging, negative while discharging
+    contribution[BATTERY_POWER] = round(payload[BATTERY_VOLTAGE] * (payload[BATTERY_CHARGE_CURRENT] -
+                                                                     payload[BATTERY_DISCHARGE_CURRENT]), 1)
+    contribution[TODAY_GENERATION] = payload[TODAY_GENERATION]
+    return contribution
+
+
+def prepare_plant_payload():
+    payload = OrderedDict(plant_aggregator.snapshot())
+    payload[MEMBERS_ONLINE] = len(payload['members'])
+    payload['last_updated'] = datetime.now(local_tz).astimezone().replace(microsecond=0).isoformat()
+
+    payload_info = OrderedDict()
+    payload_info[PAYLOAD_NAME] = payload
+    return payload_info
+
+
+def prepare_discovery_payload(sensor, params, device):
+    unique_id = device['unique_id']
     payload = OrderedDict()
     payload['name'] = '{}'.format(params['title'].title())
     payload['uniq_id'] = '{}_{}'.format(unique_id, sensor.lower())
@@ -355,8 +559,9 @@ def prepare_discovery_payload(sensor, params):
     if 'json_value' in params:
         payload['stat_t'] = values_topic_rel
         payload['val_tpl'] = '{{{{ value_json.{}.{} }}}}'.format(PAYLOAD_NAME, params['json_value'])
-    payload['~'] = sensor_base_topic
-    payload['avty_t'] = activity_topic_rel
+    payload['~'] = device['sensor_base_topic']
+    # All devices share the availability of this reporter
+    payload['avty_t'] = lwt_sensor_topic
     payload['pl_avail'] = lwt_online_val
     payload['pl_not_avail'] = lwt_offline_val
     if 'icon' in params:
@@ -368,7 +573,7 @@ def prepare_discovery_payload(sensor, params):
         payload['dev'] = {
             'identifiers': ["{}".format(unique_id)],
             'manufacturer': 'ShineMonitor PV monitoring Open platform API',
-            'name': params['device_ident'],
+            'name': params['device_ident'].format(device['sensor_name']),
             'model': 'wifiapp.volfw.solarpower',
             'sw_version': "1.1.0.1"
         }
@@ -379,49 +584,193 @@ def prepare_discovery_payload(sensor, params):
     return payload
 
 
-def publish_solar_data():
+def publish_solar_data(device, force=False):
+    start_cycle(device['sn'])
     log("Obtaining token and secret...")
-    token, secret = get_token()
-    log("Fetching data...")
-    response = get_generation_latest(token, secret)
-    log(f"Received response: {response}")
+    with span('token'):
+        token, secret = get_token()
+    log("Fetching data for {}...", device['sn'])
+    response = get_generation_latest(token, secret, device)
+    log("Received response: {}", response)
 
-    if not is_alive_timer_running():
-        publish_alive_status()
-        start_alive_timer()
+    mark_online()
 
     # Convert array of dict to key: value pair for easy parsing
     response_dict = dict()
     for value in response:
         response_dict[value['title']] = value
+    last_responses[device['sn']] = response_dict
 
     # To avoid logging duplicate data
     try:
-        with open('last_timestamp', 'r') as file:
+        with open(device['timestamp_file'], 'r') as file:
             last_timestamp = file.readline().strip()
-            if response_dict['Timestamp']['val'] == last_timestamp:
+            # A forced refresh is published anyway so the requester sees a fresh update
+            if response_dict['Timestamp']['val'] == last_timestamp and not (force or is_poll_forced(device['sn'])):
                 log("Data has not been updated, skipping this data.")
+                update_plant_member(device, response_dict)
                 return last_timestamp
     except FileNotFoundError:
         log("logging Timestamp in file...")
     finally:
-        with open('last_timestamp', 'w') as file:
+        with open(device['timestamp_file'], 'w') as file:
             file.write(response_dict['Timestamp']['val'])
 
-    _thread.start_new_thread(publish, (values_topic, json.dumps(prepare_payload(response_dict))))
+    refresh_satisfied(device['sn'])
+    with span('payload_build'):
+        payload_info = prepare_payload(response_dict, device)
+    update_plant_member(device, response_dict, payload_info)
+    _thread.start_new_thread(publish, (device['values_topic'], json.dumps(payload_info), False, get_trace_context()))
 
     return response_dict['Timestamp']['val']
 
 
+def update_plant_member(device, response_dict, payload_info=None):
+    if not config.plant_aggregate:
+        return
+    if payload_info is None:
+        # A duplicate reading still seeds the plant totals after a restart, but a bad one must not fail the poll
+        if device['sn'] in plant_aggregator.members:
+            return
+        try:
+            payload_info = prepare_payload(response_dict, device)
+        except (KeyError, ValueError):
+            log("Could not add duplicate reading of {} to the plant totals: {}", device['sn'], traceback.format_exc())
+            return
+    updated_at = datetime.strptime(response_dict['Timestamp']['val'], '%Y-%m-%d %H:%M:%S').timestamp()
+    plant_aggregator.update(device['sn'], prepare_plant_contribution(payload_info[PAYLOAD_NAME]), updated_at)
+
+
+def publish_plant_data():
+    stale = plant_aggregator.expire(time.time())
+    if stale:
+        log("Leaving stale devices out of the plant totals: {}", stale)
+    _thread.start_new_thread(publish, (plant_device['values_topic'], json.dumps(prepare_plant_payload())))
+
+
+def fetch_device(device, force=False):
+    # Returns whether the device was updated and, after a failure, how long to wait before the next attempt.
+    # Failed polling cycles back off through a breaker per device instead of shutting down.
+    poll_breaker = get_breaker('poll:' + device['sn'])
+    try:
+        print("Updating status of {}...".format(device['sn']))
+        last_time[device['sn']] = datetime.strptime(poll_breaker.call(publish_solar_data, device, force),
+                                                    '%Y-%m-%d %H:%M:%S').timestamp()
+        # print(f"Last Updated set to {last_time}")
+        return True, None
+    # A circuit is open, so skip the request and report when it may be probed again
+    except CircuitOpenError as e:
+        log(str(e))
+        return False, max(1.0, e.retry_in)
+    # For cases where internet is down, log the error once and shut down the sensors until online.
+    except ConnectionError:
+        log("Exception Found: " + traceback.format_exc())
+        if mark_offline():
+            with open('error_log.txt', 'a') as file:
+                formatted_time = datetime.fromtimestamp(time.time())
+                file.write(f'{formatted_time}\t{traceback.format_exc()}\n')
+                dump_trace(file)
+    # Any exceptions log and keep retrying with backoff
+    except Exception:
+        log("Exception Found: " + traceback.format_exc())
+        with open('error_log.txt', 'a') as file:
+            formatted_time = datetime.fromtimestamp(time.time())
+            file.write(f'{formatted_time}\t{traceback.format_exc()}\n')
+            dump_trace(file)
+    # After a failure, wake up when the backoff allows the next attempt
+    return False, max(1.0, poll_breaker.retry_in()) if poll_breaker.failures else None
+
+
+def poll_device(device, force=False):
+    # Single flight per device, a request that finds a poll in progress is coalesced into it.
+    # A refresh arriving during a scheduled poll turns that poll into a forced one instead of fetching again.
+    sn = device['sn']
+    with poll_state_lock:
+        if force and time.time() - last_refresh_time[sn] < config.refresh_min_interval_in_seconds:
+            log("{} was refreshed recently, skipping request", sn)
+            return False, None
+        if sn in polls_in_flight:
+            if force and not polls_in_flight[sn]:
+                print("Update of {} in progress, publishing its result for the refresh".format(sn))
+                polls_in_flight[sn] = True
+                pending_refreshes.add(sn)
+                last_refresh_time[sn] = time.time()
+            else:
+                log("Update of {} already in progress, coalescing request", sn)
+            return False, None
+        polls_in_flight[sn] = force
+        if force:
+            last_refresh_time[sn] = time.time()
+
+    try:
+        (updated, retry_in) = fetch_device(device, force)
+    finally:
+        with poll_state_lock:
+            del polls_in_flight[sn]
+            # Still pending if the refresh came in after the poll had already skipped a duplicate reading
+            missed_refresh = sn in pending_refreshes
+            pending_refreshes.discard(sn)
+    if missed_refresh and updated:
+        republish_device(device)
+    return updated, retry_in
+
+
+def is_poll_forced(sn):
+    with poll_state_lock:
+        return polls_in_flight.get(sn, False)
+
+
+def refresh_satisfied(sn):
+    with poll_state_lock:
+        pending_refreshes.discard(sn)
+
+
+def republish_device(device):
+    # Publishes the reading of the poll that just finished once more, without another API request
+    response_dict = last_responses.get(device['sn'])
+    try:
+        with span('payload_build'):
+            payload_info = prepare_payload(response_dict, device)
+    except (KeyError, ValueError):
+        log("Could not republish the reading of {}: {}", device['sn'], traceback.format_exc())
+        return
+    update_plant_member(device, response_dict, payload_info)
+    _thread.start_new_thread(publish, (device['values_topic'], json.dumps(payload_info)))
+
+
+def refresh_devices(selected):
+    log("Refresh requested for {}", [device['sn'] for device in selected])
+    with ThreadPoolExecutor(max_workers=len(selected)) as executor:
+        results = list(executor.map(lambda device: poll_device(device, force=True), selected))
+    # A single plant update for the whole request, and only if a device was actually updated
+    if config.plant_aggregate and any(updated for (updated, _) in results):
+        publish_plant_data()
+
+
 def publish_discovery_topic():
-    for (sensor, params) in detectors.items():
-        discovery_topic = '{}/{}/{}/{}/config'.format(config.discovery_prefix, params['topic_category'],
-                                                      config.sensor_name.lower(), sensor)
-        publish(discovery_topic, json.dumps(prepare_discovery_payload(sensor, params)), retain=True)
+    device_detectors = [(device, detectors) for device in devices]
+    if config.plant_aggregate:
+        device_detectors.append((plant_device, plant_detectors))
+    for (device, sensors) in device_detectors:
+        for (sensor, params) in sensors.items():
+            discovery_topic = '{}/{}/{}/{}/config'.format(config.discovery_prefix, params['topic_category'],
+                                                          device['sensor_name'].lower(), sensor)
+            publish(discovery_topic, json.dumps(prepare_discovery_payload(sensor, params, device)), retain=True)
+
+
+def describe_device(device, unique_id, timestamp_file=None):
+    sensor_base_topic = '{}/sensor/{}'.format(config.base_topic, device['sensor_name'].lower())
+    return dict(device,
+                unique_id=unique_id,
+                sensor_base_topic=sensor_base_topic,
+                values_topic='{}/{}'.format(sensor_base_topic, "shinemonitor"),
+                timestamp_file=timestamp_file)
 
 
 local_tz = get_localzone()
-prev_total_generation = 0.0
+prev_total_generation = dict()
+plant_aggregator = PlantAggregator(PLANT_FIELDS, PLANT_DAILY_FIELDS, config.plant_stale_after_in_minutes * 60)
+POLL_TICK_IN_SECONDS = 30
 
 # -----------------------------------------------------------------------------
 #  Main Function
@@ -430,19 +779,27 @@ prev_total_generation = 0.0
 
 if __name__ == '__main__':
     print("Starting ShineMonitor Reporter MQTT...")
-    last_time = 0
     interval_in_seconds = (config.interval_in_minutes * 60)
-    unique_id = f'ShineMonitor-{config.plant_id}-{config.pn}-{config.sn}'
+    # The first device keeps the original file name so existing installs are not affected
+    devices = [describe_device(device, f'ShineMonitor-{config.plant_id}-{device["pn"]}-{device["sn"]}',
+                               'last_timestamp' if index == 0 else 'last_timestamp_{}'.format(device['sn']))
+               for (index, device) in enumerate(configured_devices())]
+    plant_device = describe_device(dict(sensor_name=config.plant_sensor_name), f'ShineMonitor-{config.plant_id}-plant')
+    last_time = dict.fromkeys([device['sn'] for device in devices], 0)
+    last_refresh_time = dict.fromkeys([device['sn'] for device in devices], 0)
+    last_plant_time = 0
+    poll_state_lock = threading.Lock()
+    polls_in_flight = dict()  # sn -> whether the poll in progress is a forced refresh
+    pending_refreshes = set()  # refreshes that arrived during a scheduled poll
+    last_responses = dict()
 
     lwt_sensor_topic = '{}/sensor/{}/status'.format(config.base_topic, config.sensor_name.lower())
     lwt_online_val = 'online'
     lwt_offline_val = 'offline'
 
-    sensor_base_topic = '{}/sensor/{}'.format(config.base_topic, config.sensor_name.lower())
     values_topic_rel = '{}/{}'.format('~', "shinemonitor")
-    values_topic = '{}/{}'.format(sensor_base_topic, "shinemonitor")
-    activity_topic_rel = '{}/status'.format('~')  # vs. LWT
-    activity_topic = '{}/status'.format(sensor_base_topic)  # vs. LWT
+    # Publish to this topic to request an immediate refresh instead of waiting for the next poll
+    refresh_topic = '{}/sensor/{}/refresh'.format(config.base_topic, config.sensor_name.lower())
 
     # Connect to the MQTT broker
     mqtt_client = connect_mqtt()
@@ -450,41 +807,25 @@ if __name__ == '__main__':
     # Publish discovery topic for HA
     publish_discovery_topic()
 
-    # Set a counter for exceptions.
-    exception_count = 0
     # Loop until explicitly stopped
     try:
         while True:
-            try:
+            # Sleep the program so we don't query everytime
+            delay = POLL_TICK_IN_SECONDS
+            polled = False
+            for device in devices:
                 current_time = time.time()
                 # print(f"Current Time: {current_time}, Last Updated: {last_time}")
-                if current_time > last_time + interval_in_seconds:
-                    print("Updating status...")
-                    last_time = datetime.strptime(publish_solar_data(), '%Y-%m-%d %H:%M:%S').timestamp()
-                    exception_count = 0  # reset exception counter if successfully executed
-                    # print(f"Last Updated set to {last_time}")
-
-                # Sleep the program so we don't query everytime
-                sleep(30)
-            # For cases where internet is down, log the error once and shut down the sensors until online.
-            except ConnectionError:
-                # TODO issue with not reconnecting on restart
-                log("Exception Found: " + traceback.format_exc())
-                if is_alive_timer_running():
-                    with open('error_log.txt', 'a') as file:
-                        formatted_time = datetime.fromtimestamp(time.time())
-                        file.write(f'{formatted_time}\t{traceback.format_exc()}\n')
-                    mqtt_client.publish(lwt_sensor_topic, payload=lwt_offline_val, retain=False)
-                    stop_alive_timer()
-            # Any exceptions log and keep and retry at least 3 times before shutting down
-            except Exception:
-                exception_count += 1
-                log("Exception Found: " + traceback.format_exc())
-                with open('error_log.txt', 'a') as file:
-                    formatted_time = datetime.fromtimestamp(time.time())
-                    file.write(f'{formatted_time}\t{traceback.format_exc()}\n')
-                if exception_count >= 3:
-                    raise
+                if current_time > last_time[device['sn']] + interval_in_seconds:
+                    (updated, retry_in) = poll_device(device)
+                    if retry_in:
+                        delay = min(delay, retry_in)
+                    polled = polled or updated
+            # The plant is also republished on its own schedule so stale members expire even when every poll fails
+            if config.plant_aggregate and (polled or time.time() > last_plant_time + interval_in_seconds):
+                publish_plant_data()
+                last_plant_time = time.time()
+            sleep(delay)
     finally:
         publish_shutdown_status()
         mqtt_client.disconnect()
@@ -1,6 +1,108 @@
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
 import config
 
 
-def log(string: str):
+def log(string: str, *args):
+    # Format arguments are only applied when debug is on, so callers can pass large values for free.
     if config.debug:
-        print(string)
+        print(string.format(*args) if args else string)
+
+
+# -----------------------------------------------------------------------------
+#  Tracing Functions
+# -----------------------------------------------------------------------------
+
+_NULL_SPAN = contextlib.nullcontext()
+_trace_lock = threading.Lock()
+_trace_buffer = deque(maxlen=config.trace_buffer_size)
+_trace_cycles = itertools.count(1)
+# The cycle and device a span belongs to, kept per thread so concurrent polls are not mixed up
+_trace_context = threading.local()
+
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.cycle, self.device = get_trace_context()
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(error=exc_type.__name__ if exc_type is not None else None)
+        return False
+
+    def close(self, perf_end=None, error=None):
+        record = dict(
+            cycle=self.cycle,
+            device=self.device,
+            span=self.name,
+            start=round(self.start, 3),
+            duration_ms=round(((perf_end or time.perf_counter()) - self.perf_start) * 1000, 3),
+        )
+        record.update(self.attrs)
+        if error is not None:
+            record['error'] = error
+        write_span(record)
+
+
+def span(name: str, **attrs):
+    # Returns a shared no-op context manager when tracing is disabled, so spans cost nothing.
+    if not config.trace:
+        return _NULL_SPAN
+    return _Span(name, attrs)
+
+
+def open_span(name: str, **attrs):
+    # For spans that end later, possibly in another thread, e.g. when the broker acknowledges a message.
+    # Returns None when tracing is disabled, otherwise call close() on the span once it is done.
+    if not config.trace:
+        return None
+    return _Span(name, attrs).__enter__()
+
+
+def start_cycle(device=None):
+    context = (next(_trace_cycles), device)
+    set_trace_context(context)
+    return context
+
+
+def get_trace_context():
+    return getattr(_trace_context, 'value', (0, None))
+
+
+def set_trace_context(context):
+    # Used to carry the current cycle over to a thread that works on its behalf, e.g. publishing
+    _trace_context.value = context
+
+
+def write_span(record: dict):
+    line = json.dumps(record)
+    with _trace_lock:
+        _trace_buffer.append(line)
+        if config.trace_file:
+            if os.path.exists(config.trace_file) and os.path.getsize(config.trace_file) > config.trace_file_max_bytes:
+                os.replace(config.trace_file, config.trace_file + '.1')
+            with open(config.trace_file, 'a') as file:
+                file.write(line + '\n')
+
+
+def dump_trace(file):
+    # Write the buffered spans to an already open file (e.g. error_log.txt) and clear the buffer.
+    with _trace_lock:
+        if not _trace_buffer:
+            return
+        file.write('Trace of recent spans:\n')
+        for line in _trace_buffer:
+            file.write(f'\t{line}\n')
+        _trace_buffer.clear()